@@ -1,19 +1,41 @@
 import os
+import json
+import hashlib
+import asyncio
 import uuid
 import tempfile
 import shutil
-import sys
 import time
+import queue
+import random
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Optional, Dict
-import subprocess
 
+import anyio.to_thread
 import torch
-from fastapi import FastAPI, UploadFile, File, BackgroundTasks, HTTPException, Form
+import torch.nn.functional as F
+import torchaudio
+
+# Usar Tensor Cores (TF32) nas multiplicações de matrizes e convoluções
+torch.set_float32_matmul_precision('high')
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
+
+import demucs.pretrained
+from demucs.apply import BagOfModels
+from demucs.audio import AudioFile, convert_audio_channels, save_audio
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 import boto3
+import redis
+import redis.asyncio
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 
 # Configuração da aplicação
@@ -28,9 +50,55 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Armazenar jobs em execução
+# Armazenar jobs em execução (em memória quando o Redis não estiver configurado)
 JOBS = {}
+JOB_TTL = 24 * 60 * 60
+# Resultados já processados, indexados pelo hash do arquivo e pelos parâmetros
+# (em memória: LRU limitado, com expiração; valores são (expira_em, resultado))
+RESULT_CACHE: "OrderedDict[str, tuple]" = OrderedDict()
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 1024))
+RESULT_CACHE_LOCK = threading.Lock()
+RESULT_TTL = 30 * 24 * 60 * 60
+
+# Fila de jobs consumida pelos workers de GPU (por padrão, um job por vez na GPU)
+JOB_QUEUE: asyncio.Queue = asyncio.Queue()
+WORKER_TASKS: List[asyncio.Task] = []
+GPU_WORKERS = int(os.environ.get("GPU_WORKERS", 1))
+# Threads exclusivas dos jobs de GPU; o executor padrão do loop fica livre (ex.: getaddrinfo do Redis)
+GPU_EXECUTOR = ThreadPoolExecutor(max_workers=GPU_WORKERS)
+# Threads para o trabalho bloqueante de CPU (leitura de arquivos, codificação, uploads)
+CPU_WORKERS = min(4, os.cpu_count() or 1)
+UPLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=CPU_WORKERS)
+# Tamanho dos blocos lidos do upload (1 MiB)
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Configurações Redis, para compartilhar o estado dos jobs entre vários workers
+REDIS_URL = os.environ.get('REDIS_URL')
+# Cliente síncrono para as threads de processamento e assíncrono para os endpoints
+redis_client = redis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+async_redis_client = redis.asyncio.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+
 AVAILABLE_MODELS = ["htdemucs", "htdemucs_ft", "mdx_extra", "mdx_q"]
+# Formatos de saída dos stems e seus content-types
+OUTPUT_FORMATS = {"mp3": "audio/mpeg", "flac": "audio/flac", "wav": "audio/wav"}
+
+# Modelos carregados uma única vez e mantidos em memória
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+MODEL_CACHE: Dict[str, torch.nn.Module] = {}
+# Precisão mista (FP16) na inferência; desativada por padrão pois a parte STFT do Demucs é sensível
+USE_FP16 = os.environ.get("DEMUCS_FP16", "0") == "1" and DEVICE == "cuda"
+# Compilar os modelos com torch.compile (fusão de kernels); a primeira execução fica mais lenta
+USE_COMPILE = os.environ.get("DEMUCS_COMPILE", "0") == "1" and DEVICE == "cuda"
+# Capturar o forward dos modelos em CUDA Graphs para eliminar o custo de lançamento de kernels
+USE_CUDA_GRAPHS = os.environ.get("DEMUCS_CUDA_GRAPHS", "0") == "1" and DEVICE == "cuda"
+# Pool de memória único para todos os grafos, em vez de um pool reservado por modelo
+CUDA_GRAPH_POOL = torch.cuda.graph_pool_handle() if USE_CUDA_GRAPHS else None
+# Número máximo de segmentos processados juntos em uma única chamada ao modelo
+BATCH_SIZE = int(os.environ.get("DEMUCS_BATCH_SIZE", 4))
+# Sobreposição entre segmentos consecutivos (mesmo padrão do apply_model)
+OVERLAP = 0.25
+# Segmentos de um job aguardando no batcher; limita a memória da GPU ocupada pelas saídas
+MAX_IN_FLIGHT = 2 * BATCH_SIZE
 
 # Configurações S3
 S3_BUCKET = os.environ.get('AWS_STORAGE_BUCKET_NAME')
@@ -40,40 +108,204 @@ s3_client = boto3.client(
     aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
     region_name=os.environ.get('AWS_REGION', 'us-east-1')
 )
+# Uploads multipart em paralelo para arquivos grandes
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 << 20, max_concurrency=8, use_threads=True)
 
 # Classe para o resultado da separação
 class SeparationResult(BaseModel):
-    vocals: str
-    drums: str
-    bass: str
-    other: str
+    vocals: Optional[str] = None
+    drums: Optional[str] = None
+    bass: Optional[str] = None
+    other: Optional[str] = None
+    # Presente apenas no modo two_stems, junto com o stem escolhido
+    accompaniment: Optional[str] = None
     id: str
 
-# Função para baixar os modelos Demucs
-def download_models():
-    try:
-        print("Iniciando download dos modelos Demucs...")
-        # Criar diretório de cache para o modelo
-        model_path = Path.home() / ".cache" / "torch" / "hub" / "checkpoints"
-        os.makedirs(model_path.parent, exist_ok=True)
-        
-        # Baixar os modelos um a um (sem processar nenhum áudio)
-        for model in AVAILABLE_MODELS:
-            print(f"Baixando modelo {model}...")
-            cmd = ["python", "-c", f"import torch; import demucs.pretrained; model = demucs.pretrained.get_model('{model}')"]
-            subprocess.run(cmd, check=True)
-            print(f"Modelo {model} baixado com sucesso")
-        
-        print("Todos os modelos Demucs foram baixados com sucesso")
-    except Exception as e:
-        print(f"Erro ao baixar modelos: {e}")
+# Forward capturado em CUDA Graph, um grafo por formato de entrada
+class CUDAGraphForward:
+    # Todos os grafos compartilham CUDA_GRAPH_POOL, então capturas e replays precisam
+    # ser serializados entre todos os modelos, e a saída copiada antes do próximo replay
+    lock = threading.Lock()
+
+    def __init__(self, forward, warmup_iters: int = 3):
+        self.forward = forward
+        self.warmup_iters = warmup_iters
+        self.graphs = {}
+
+    def capture(self, x: torch.Tensor):
+        static_input = x.clone()
+        # Aquecer em uma stream separada antes da captura, como exigido pelo PyTorch
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(self.warmup_iters):
+                self.forward(static_input)
+        torch.cuda.current_stream().wait_stream(stream)
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph, pool=CUDA_GRAPH_POOL):
+            static_output = self.forward(static_input)
+        return graph, static_input, static_output
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        if not x.is_cuda:
+            return self.forward(x)
+        key = (tuple(x.shape), x.dtype, torch.is_autocast_enabled())
+        with self.lock:
+            if key not in self.graphs:
+                print(f"Capturando CUDA Graph para entrada {tuple(x.shape)}")
+                self.graphs[key] = self.capture(x)
+            graph, static_input, static_output = self.graphs[key]
+            static_input.copy_(x)
+            graph.replay()
+            # A saída estática é sobrescrita no próximo replay
+            return static_output.clone()
+
+# Contexto usado em toda inferência (precisão mista opcional)
+def inference_context():
+    # O cache de pesos do autocast não é compatível com a captura de CUDA Graphs
+    return torch.autocast("cuda", dtype=torch.float16, enabled=USE_FP16, cache_enabled=not USE_CUDA_GRAPHS)
+
+# Lista dos modelos internos (um BagOfModels agrupa vários modelos)
+def sub_models(model: torch.nn.Module) -> List[torch.nn.Module]:
+    if isinstance(model, BagOfModels):
+        return list(model.models)
+    return [model]
+
+# Compilar o forward de cada modelo interno com torch.compile
+def compile_model(model: torch.nn.Module):
+    # Em caso de falha na compilação, voltar para a execução normal (eager)
+    torch._dynamo.config.suppress_errors = True
+    for sub_model in sub_models(model):
+        sub_model.forward = torch.compile(sub_model.forward)
+
+# Capturar o forward de cada modelo interno em CUDA Graphs (a captura ocorre no aquecimento)
+def capture_cuda_graphs(model: torch.nn.Module):
+    for sub_model in sub_models(model):
+        sub_model.forward = CUDAGraphForward(sub_model.forward)
+
+# Executar um forward em cada formato de lote usado pelo batcher, para que o autotune
+# do cuDNN aconteça ao iniciar e não no primeiro job
+def warmup_model(model: torch.nn.Module):
+    start = time.time()
+    # Sem CUDA Graphs o último lote de um job pode ser menor que BATCH_SIZE
+    batch_sizes = [BATCH_SIZE] if USE_CUDA_GRAPHS else range(1, BATCH_SIZE + 1)
+    for sub_model in sub_models(model):
+        _, valid_length = segment_lengths(sub_model)
+        for batch_size in batch_sizes:
+            dummy = torch.zeros(batch_size, sub_model.audio_channels, valid_length, device=DEVICE)
+            with torch.inference_mode(), inference_context():
+                sub_model(dummy)
+    torch.cuda.synchronize()
+    print(f"Aquecimento concluído em {time.time() - start:.1f}s")
+
+# Função para carregar os modelos Demucs
+def load_models():
+    print(f"Carregando modelos Demucs no dispositivo {DEVICE}...")
+    # Carregar os modelos um a um e mantê-los em memória
+    for name in AVAILABLE_MODELS:
+        try:
+            print(f"Carregando modelo {name}...")
+            model = demucs.pretrained.get_model(name)
+            model.to(DEVICE).eval()
+            if USE_COMPILE:
+                compile_model(model)
+            if USE_CUDA_GRAPHS:
+                capture_cuda_graphs(model)
+            if DEVICE == "cuda":
+                warmup_model(model)
+            MODEL_CACHE[name] = model
+            print(f"Modelo {name} carregado com sucesso")
+        except Exception as e:
+            print(f"Erro ao carregar modelo {name}: {e}")
+    
+    print(f"Modelos Demucs carregados: {', '.join(MODEL_CACHE)}")
+
+# Estado dos jobs
+def job_key(job_id: str) -> str:
+    return f"job:{job_id}"
+
+def encode_job(fields: dict) -> Dict[str, str]:
+    return {key: json.dumps(value) for key, value in fields.items()}
+
+def decode_job(data: Dict[str, str]) -> dict:
+    return {key: json.loads(value) for key, value in data.items()}
+
+# Atualizar campos de um job (usado pelas threads de processamento)
+def update_job(job_id: str, **fields):
+    # Revisão do job, usada como ETag no /status
+    fields["_rev"] = time.time_ns()
+    if redis_client is None:
+        JOBS.setdefault(job_id, {}).update(fields)
+        return
+    pipe = redis_client.pipeline()
+    pipe.hset(job_key(job_id), mapping=encode_job(fields))
+    pipe.expire(job_key(job_id), JOB_TTL)
+    pipe.execute()
+
+# Criar um job (usado pelos endpoints)
+async def create_job(job_id: str, **fields):
+    fields["_rev"] = time.time_ns()
+    if async_redis_client is None:
+        JOBS[job_id] = fields
+        return
+    pipe = async_redis_client.pipeline()
+    pipe.hset(job_key(job_id), mapping=encode_job(fields))
+    pipe.expire(job_key(job_id), JOB_TTL)
+    await pipe.execute()
+
+# Buscar um job (usado pelos endpoints)
+async def get_job(job_id: str) -> Optional[dict]:
+    if async_redis_client is None:
+        return JOBS.get(job_id)
+    data = await async_redis_client.hgetall(job_key(job_id))
+    return decode_job(data) if data else None
+
+# Cache de resultados por conteúdo do arquivo
+def result_key(digest: str, model: str, two_stems: Optional[str], shifts: int, output_format: str) -> str:
+    return f"result:sha256:{digest}:{model}:{two_stems or ''}:{shifts}:{output_format}"
+
+# Guardar o resultado de um job (usado pelas threads de processamento)
+def set_cached_result(key: str, result: dict):
+    if redis_client is None:
+        with RESULT_CACHE_LOCK:
+            RESULT_CACHE[key] = (time.time() + RESULT_TTL, result)
+            RESULT_CACHE.move_to_end(key)
+            while len(RESULT_CACHE) > RESULT_CACHE_SIZE:
+                RESULT_CACHE.popitem(last=False)
+        return
+    redis_client.set(key, json.dumps(result), ex=RESULT_TTL)
+
+# Buscar um resultado já processado (usado pelos endpoints)
+async def get_cached_result(key: str) -> Optional[dict]:
+    if async_redis_client is None:
+        with RESULT_CACHE_LOCK:
+            entry = RESULT_CACHE.get(key)
+            if entry is None:
+                return None
+            expires_at, result = entry
+            if expires_at < time.time():
+                del RESULT_CACHE[key]
+                return None
+            RESULT_CACHE.move_to_end(key)
+            return result
+    data = await async_redis_client.get(key)
+    return json.loads(data) if data else None
+
+# Buscar apenas a revisão de um job, para responder ao /status sem ler o job inteiro
+async def get_job_rev(job_id: str) -> Optional[int]:
+    if async_redis_client is None:
+        job = await get_job(job_id)
+        return job["_rev"] if job is not None else None
+    rev = await async_redis_client.hget(job_key(job_id), "_rev")
+    return json.loads(rev) if rev else None
 
 # Upload para o S3
-def upload_to_s3(file_path, object_name):
+def upload_to_s3(file_path, object_name, content_type=None):
     """Upload a file to S3 bucket"""
     try:
         print(f"Fazendo upload do arquivo {file_path} para S3 como {object_name}")
-        s3_client.upload_file(file_path, S3_BUCKET, object_name)
+        extra_args = {"ContentType": content_type} if content_type else None
+        s3_client.upload_file(file_path, S3_BUCKET, object_name, ExtraArgs=extra_args, Config=TRANSFER_CONFIG)
         # Construir URL pública
         url = f"https://{S3_BUCKET}.s3.amazonaws.com/{object_name}"
         print(f"Upload concluído, URL: {url}")
@@ -82,112 +314,235 @@ def upload_to_s3(file_path, object_name):
         print(f"Erro ao fazer upload para S3: {e}")
         return None
 
+# Codificar um stem e enviá-lo ao S3 (executado em paralelo para todos os stems)
+def save_and_upload(source: torch.Tensor, file_path: str, object_name: str, samplerate: int, output_format: str):
+    save_audio(source, file_path, samplerate=samplerate, bitrate=320)
+    return upload_to_s3(file_path, object_name, OUTPUT_FORMATS[output_format])
+
+# Agrupa segmentos de todos os jobs em lotes por modelo e executa-os em uma única thread
+class ChunkBatcher:
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, model: torch.nn.Module, chunk: torch.Tensor) -> Future:
+        future = Future()
+        self.queue.put((model, chunk, future))
+        return future
+
+    def run(self):
+        pending = []
+        while True:
+            if not pending:
+                pending.append(self.queue.get())
+            # Juntar tudo o que já está na fila para formar lotes maiores
+            while True:
+                try:
+                    pending.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            model = pending[0][0]
+            batch = [item for item in pending if item[0] is model][:self.batch_size]
+            pending = [item for item in pending if not any(item is other for other in batch)]
+            self.run_batch(model, batch)
+
+    def run_batch(self, model: torch.nn.Module, batch: list):
+        # Ignorar segmentos de jobs que já falharam (futures canceladas)
+        batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+        if batch:
+            self.execute(model, batch)
+
+    def forward(self, model: torch.nn.Module, batch: list) -> torch.Tensor:
+        chunks = torch.stack([chunk for _, chunk, _ in batch])
+        # Com CUDA Graphs o formato precisa ser fixo, então completar o lote com zeros
+        if USE_CUDA_GRAPHS and len(batch) < self.batch_size:
+            padding = chunks.new_zeros((self.batch_size - len(batch),) + chunks.shape[1:])
+            chunks = torch.cat([chunks, padding])
+        with torch.inference_mode(), inference_context():
+            return model(chunks).float()
+
+    def execute(self, model: torch.nn.Module, batch: list):
+        try:
+            out = self.forward(model, batch)
+            for index, (_, _, future) in enumerate(batch):
+                future.set_result(out[index])
+            return
+        except Exception as e:
+            # Sem o traceback, as ativações do forward que falhou podem ser liberadas
+            error = e.with_traceback(None)
+        
+        # Sem memória para o lote inteiro: tentar segmento a segmento, para que a falha
+        # atinja apenas os segmentos (e jobs) que realmente não couberem
+        if isinstance(error, torch.cuda.OutOfMemoryError) and len(batch) > 1:
+            torch.cuda.empty_cache()
+            for item in batch:
+                self.execute(model, [item])
+            return
+        for _, _, future in batch:
+            future.set_exception(error)
+
+BATCHER = ChunkBatcher(BATCH_SIZE)
+
+# Tamanho do segmento e tamanho da entrada esperada pelo modelo
+def segment_lengths(model: torch.nn.Module):
+    segment_length = int(model.segment * model.samplerate)
+    valid_length = segment_length
+    if hasattr(model, "valid_length"):
+        valid_length = model.valid_length(segment_length)
+    return segment_length, valid_length
+
+# Separar o áudio em segmentos sobrepostos pelo batcher e recombiná-los com janelas
+# triangulares (overlap-add), mantendo no máximo MAX_IN_FLIGHT segmentos pendentes
+def separate_chunks(model: torch.nn.Module, mix: torch.Tensor) -> torch.Tensor:
+    length = mix.shape[-1]
+    segment_length, valid_length = segment_lengths(model)
+    stride = int((1 - OVERLAP) * segment_length)
+    context = (valid_length - segment_length) // 2
+    padded = F.pad(mix, (context, valid_length))
+    weight = torch.cat([
+        torch.arange(1, segment_length // 2 + 1, device=DEVICE),
+        torch.arange(segment_length - segment_length // 2, 0, -1, device=DEVICE)
+    ]).float()
+    weight = weight / weight.max()
+    out = torch.zeros(len(model.sources), model.audio_channels, length + segment_length, device=DEVICE)
+    sum_weight = torch.zeros(length + segment_length, device=DEVICE)
+    
+    def add_chunk(offset: int, future: Future):
+        chunk_out = future.result()[..., context:context + segment_length]
+        out[..., offset:offset + segment_length] += weight * chunk_out
+        sum_weight[offset:offset + segment_length] += weight
+    
+    in_flight = deque()
+    try:
+        for offset in range(0, length, stride):
+            in_flight.append((offset, BATCHER.submit(model, padded[:, offset:offset + valid_length])))
+            if len(in_flight) >= MAX_IN_FLIGHT:
+                add_chunk(*in_flight.popleft())
+        while in_flight:
+            add_chunk(*in_flight.popleft())
+    finally:
+        # Em caso de erro, não processar os segmentos que ainda estão na fila
+        for _, future in in_flight:
+            future.cancel()
+    
+    return out[..., :length] / sum_weight[:length]
+
+# Copiar o áudio para a GPU a partir de memória fixada (pinned), sem cópia intermediária paginável
+def to_device(wav: torch.Tensor) -> torch.Tensor:
+    if DEVICE != "cuda":
+        return wav
+    return wav.pin_memory().to(DEVICE, non_blocking=True)
+
+# Carregar o áudio direto para o dispositivo, já no formato esperado pelo modelo
+def load_audio(file_path: str, model: torch.nn.Module) -> torch.Tensor:
+    try:
+        wav, samplerate = torchaudio.load(file_path)
+    except RuntimeError as e:
+        # Formato não suportado pelo torchaudio: decodificar com ffmpeg, como a CLI do Demucs
+        print(f"torchaudio não conseguiu ler {file_path} ({e}), usando ffmpeg")
+        wav = AudioFile(file_path).read(streams=0, samplerate=model.samplerate, channels=model.audio_channels)
+        return to_device(wav)
+    
+    # Conversão de canais e reamostragem feitas no dispositivo (GPU)
+    wav = convert_audio_channels(to_device(wav), model.audio_channels)
+    if samplerate != model.samplerate:
+        wav = torchaudio.functional.resample(wav, samplerate, model.samplerate)
+    return wav
+
+# Separar um áudio (canais, amostras) com o modelo informado
+def separate_track(model: torch.nn.Module, wav: torch.Tensor, shifts: int = 1) -> torch.Tensor:
+    # Normalizar como a CLI do Demucs faz
+    ref = wav.mean(0)
+    wav = (wav - ref.mean()) / ref.std()
+    
+    if isinstance(model, BagOfModels):
+        weights = [torch.tensor(w, dtype=torch.float32, device=DEVICE) for w in model.weights]
+    else:
+        weights = [torch.ones(len(model.sources), device=DEVICE)]
+    # Deslocamentos aleatórios (shift trick), como no apply_model
+    max_shift = int(0.5 * model.samplerate)
+    offsets = [random.randint(0, max_shift) for _ in range(shifts)] if shifts > 0 else [0]
+    
+    with torch.inference_mode():
+        estimates = 0
+        for shift in offsets:
+            shifted = F.pad(wav, (shift, 0))
+            for sub_model, weight in zip(sub_models(model), weights):
+                out = separate_chunks(sub_model, shifted)[..., shift:]
+                estimates = estimates + out * weight[:, None, None]
+        estimates = estimates / (sum(weights)[:, None, None] * len(offsets))
+    
+    return (estimates * ref.std() + ref.mean()).cpu()
+
 # Função para executar a separação em background
-def process_audio(file_path: str, job_id: str, model: str = "htdemucs", two_stems: Optional[str] = None, shifts: int = 1):
+def process_audio(file_path: str, job_id: str, model: str = "htdemucs", two_stems: Optional[str] = None, shifts: int = 1, output_format: str = "mp3", cache_key: Optional[str] = None):
     try:
         # Atualizar status
-        JOBS[job_id]["status"] = "processing"
-        JOBS[job_id]["progress"] = 0.1
+        update_job(job_id, status="processing", progress=0.1)
         print(f"Iniciando processamento do job {job_id} com modelo {model}")
         
         # Criar diretório temporário para saída
         output_dir = Path(tempfile.mkdtemp())
         print(f"Diretório temporário criado: {output_dir}")
         
-        # Configurar argumentos para o Demucs
-        args = []
-        
-        if model:
-            args.extend(["-n", model])
-        
-        if two_stems:
-            args.extend(["--two-stems", two_stems])
-        
-        if shifts > 1:
-            args.extend(["--shifts", str(shifts)])
-        
-        # Adicionar formato e qualidade
-        args.extend(["--mp3", "--mp3-bitrate", "320"])
-        
-        # Adicionar arquivo e diretório de saída
-        args.extend(["-o", str(output_dir), file_path])
-        
-        # Executar Demucs usando sys.argv
-        print(f"Executando Demucs com argumentos: {args}")
-        JOBS[job_id]["progress"] = 0.2
+        if model not in MODEL_CACHE:
+            raise Exception(f"Modelo {model} não está carregado")
+        demucs_model = MODEL_CACHE[model]
         
-        # Usar sys.argv em vez de passar argumentos diretamente
-        original_argv = sys.argv
-        sys.argv = ['demucs.separate'] + args
+        # Carregar o áudio na taxa de amostragem e número de canais do modelo
+        wav = load_audio(file_path, demucs_model)
+        update_job(job_id, progress=0.2)
         
-        import demucs.separate
-        demucs.separate.main()
-        
-        # Restaurar sys.argv
-        sys.argv = original_argv
-        
-        # Processar os arquivos de saída
-        JOBS[job_id]["progress"] = 0.8
-        model_dir = output_dir / model
-        track_name = Path(file_path).stem
-        track_dir = model_dir / track_name
+        # Executar a separação no próprio processo, com o modelo já carregado
+        print(f"Executando Demucs com modelo {model} (shifts={shifts})")
+        out_of_memory = False
+        try:
+            sources = separate_track(demucs_model, wav, shifts)
+        except torch.cuda.OutOfMemoryError:
+            # Apenas marcar: dentro do except o traceback mantém vivos os tensores da tentativa
+            out_of_memory = True
+        if out_of_memory:
+            # Liberar o cache do alocador apenas quando faltar memória e tentar mais uma vez
+            print(f"Memória da GPU insuficiente no job {job_id}, liberando cache e tentando novamente")
+            torch.cuda.empty_cache()
+            sources = separate_track(demucs_model, wav, shifts)
         
-        print(f"Processamento concluído, buscando stems em {track_dir}")
+        # Stems esperados: as quatro fontes, ou o stem escolhido e o acompanhamento
+        update_job(job_id, progress=0.8)
+        outputs = dict(zip(demucs_model.sources, sources))
+        if two_stems:
+            primary = outputs.pop(two_stems)
+            outputs = {two_stems: primary, "accompaniment": sum(outputs.values())}
         
-        # Fazer upload de cada stem para o S3
-        stems = {}
-        for stem in ["vocals", "drums", "bass", "other"]:
-            stem_file = track_dir / f"{stem}.mp3"
-            if stem_file.exists():
-                print(f"Encontrado arquivo {stem}.mp3, fazendo upload...")
-                s3_path = f"{job_id}/{stem}.mp3"
-                url = upload_to_s3(str(stem_file), s3_path)
-                if url:
-                    stems[stem] = url
-                else:
-                    raise Exception(f"Falha no upload do stem {stem}")
-            else:
-                print(f"Arquivo {stem}.mp3 não encontrado")
-                # Se o formato two_stems foi usado, alguns stems não existirão
-                if two_stems:
-                    if stem == two_stems:
-                        print(f"Stem {stem} esperado, mas não encontrado!")
-                    else:
-                        print(f"Stem {stem} não esperado para o modo two_stems={two_stems}")
-                else:
-                    print(f"ALERTA: Stem {stem} não encontrado quando deveria existir")
+        print(f"Processamento concluído, enviando stems: {', '.join(outputs)} ({output_format})")
         
-        # Verificar se temos os stems necessários
-        if two_stems:
-            if two_stems not in stems:
-                raise Exception(f"Stem {two_stems} não foi gerado")
-        else:
-            required_stems = {"vocals", "drums", "bass", "other"}
-            missing_stems = required_stems - set(stems.keys())
-            if missing_stems:
-                raise Exception(f"Os seguintes stems não foram gerados: {', '.join(missing_stems)}")
+        # Codificar e fazer upload de todos os stems em paralelo; o envio de um stem
+        # pronto acontece enquanto os outros ainda estão sendo codificados
+        futures = {
+            stem: UPLOAD_EXECUTOR.submit(
+                save_and_upload,
+                source,
+                str(output_dir / f"{stem}.{output_format}"),
+                f"{job_id}/{stem}.{output_format}",
+                demucs_model.samplerate,
+                output_format
+            )
+            for stem, source in outputs.items()
+        }
+        stems = {stem: future.result() for stem, future in futures.items()}
         
-        # Se estivermos no modo two_stems, criar stems fictícios para os outros
-        if two_stems:
-            primary_stem = two_stems
-            accomp_path = f"{job_id}/accompaniment.mp3"
-            
-            # No modo two_stems, o Demucs cria um arquivo "no_{stem}.mp3" para o acompanhamento
-            accomp_file = track_dir / f"no_{primary_stem}.mp3"
-            if accomp_file.exists():
-                url = upload_to_s3(str(accomp_file), accomp_path)
-                
-                # Preencher todos os outros stems com a mesma URL do acompanhamento
-                for stem in ["vocals", "drums", "bass", "other"]:
-                    if stem != primary_stem:
-                        stems[stem] = url
+        failed_stems = [stem for stem, url in stems.items() if not url]
+        if failed_stems:
+            raise Exception(f"Falha no upload dos stems: {', '.join(failed_stems)}")
         
-        result = {**stems, "id": job_id}
+        result = SeparationResult(id=job_id, **stems).model_dump(exclude_none=True)
         
         # Atualizar status para completo
-        JOBS[job_id]["status"] = "completed"
-        JOBS[job_id]["progress"] = 1.0
-        JOBS[job_id]["result"] = result
+        update_job(job_id, status="completed", progress=1.0, result=result)
+        if cache_key:
+            set_cached_result(cache_key, result)
         
         print(f"Job {job_id} concluído com sucesso")
         
@@ -198,8 +553,10 @@ def process_audio(file_path: str, job_id: str, model: str = "htdemucs", two_stem
         
     except Exception as e:
         print(f"Erro processando job {job_id}: {e}")
-        JOBS[job_id]["status"] = "failed"
-        JOBS[job_id]["error"] = str(e)
+        try:
+            update_job(job_id, status="failed", error=str(e))
+        except Exception as status_error:
+            print(f"Erro ao atualizar status do job {job_id}: {status_error}")
         
         # Tentar limpar arquivos temporários mesmo em caso de erro
         try:
@@ -210,13 +567,25 @@ def process_audio(file_path: str, job_id: str, model: str = "htdemucs", two_stem
         except Exception as cleanup_error:
             print(f"Erro ao limpar arquivos temporários: {cleanup_error}")
 
+# Worker que consome a fila de jobs e executa o processamento no executor de GPU
+async def gpu_worker():
+    while True:
+        args = await JOB_QUEUE.get()
+        try:
+            await asyncio.get_running_loop().run_in_executor(GPU_EXECUTOR, process_audio, *args)
+        except Exception as e:
+            # Um erro inesperado não pode encerrar o worker, senão a fila para de ser consumida
+            print(f"Erro inesperado no worker de GPU (job {args[1]}): {e}")
+        finally:
+            JOB_QUEUE.task_done()
+
 @app.post("/separate")
 async def separate_audio(
-    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     model: str = Form("htdemucs"),
     two_stems: Optional[str] = Form(None),
-    shifts: int = Form(1)
+    shifts: int = Form(1),
+    output_format: str = Form("mp3")
 ):
     # Validar modelo
     if model not in AVAILABLE_MODELS:
@@ -226,35 +595,48 @@ async def separate_audio(
     if two_stems and two_stems not in ["vocals", "drums", "bass", "other"]:
         raise HTTPException(status_code=400, detail="two_stems deve ser 'vocals', 'drums', 'bass' ou 'other'")
     
+    # Validar formato de saída
+    if output_format not in OUTPUT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Formato inválido. Escolha entre: {', '.join(OUTPUT_FORMATS)}")
+    
     # Criar ID único para o job
     job_id = str(uuid.uuid4())
     
     # Salvar arquivo temporariamente
     temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=Path(file.filename).suffix)
     try:
-        contents = await file.read()
+        # Gravar o upload em blocos, sem carregar o arquivo inteiro na memória,
+        # calculando o hash do conteúdo ao mesmo tempo
+        digest = hashlib.sha256()
         with temp_file as f:
-            f.write(contents)
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                digest.update(chunk)
+                f.write(chunk)
         
         print(f"Arquivo recebido: {file.filename}, salvo como {temp_file.name}")
         
-        # Inicializar job
-        JOBS[job_id] = {
-            "status": "queued",
-            "progress": 0,
-            "file_path": temp_file.name
-        }
+        # Se o mesmo arquivo já foi processado com os mesmos parâmetros, devolver o resultado
+        cache_key = result_key(digest.hexdigest(), model, two_stems, shifts, output_format)
+        cached = await get_cached_result(cache_key)
+        if cached is not None:
+            print(f"Arquivo já processado anteriormente, reutilizando resultado do job {cached['id']}")
+            os.unlink(temp_file.name)
+            # Os stems continuam no S3 sob o job original; o resultado leva o ID do novo job
+            result = {**cached, "id": job_id}
+            await create_job(job_id, status="completed", progress=1.0, result=result)
+            return {"id": job_id, "status": "completed", "result": result}
         
-        # Iniciar processamento em background
-        background_tasks.add_task(
-            process_audio,
-            temp_file.name,
+        # Inicializar job
+        await create_job(
             job_id,
-            model,
-            two_stems,
-            shifts
+            status="queued",
+            progress=0,
+            file_path=temp_file.name
         )
         
+        # Colocar o job na fila de processamento
+        await JOB_QUEUE.put((temp_file.name, job_id, model, two_stems, shifts, output_format, cache_key))
+        
         return {"id": job_id, "status": "queued"}
     
     except Exception as e:
@@ -263,12 +645,28 @@ async def separate_audio(
             os.unlink(temp_file.name)
         raise HTTPException(status_code=500, detail=str(e))
 
+# Comparação fraca de ETags (RFC 9110): o If-None-Match pode ser "*" ou uma lista separada por vírgulas
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in (tag.removeprefix("W/") for tag in tags)
+
 @app.get("/status/{job_id}")
-async def check_status(job_id: str):
-    if job_id not in JOBS:
+async def check_status(job_id: str, request: Request):
+    rev = await get_job_rev(job_id)
+    if rev is None:
+        raise HTTPException(status_code=404, detail="Job não encontrado")
+    
+    # O cliente já tem a versão atual do job
+    etag = f'W/"{rev}"'
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    
+    job = await get_job(job_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job não encontrado")
     
-    job = JOBS[job_id]
     response = {
         "status": job["status"],
         "progress": job.get("progress", 0)
@@ -279,7 +677,7 @@ async def check_status(job_id: str):
     elif job["status"] == "failed" and "error" in job:
         response["error"] = job["error"]
     
-    return response
+    return JSONResponse(response, headers={"ETag": f'W/"{job["_rev"]}"', "Cache-Control": "no-cache"})
 
 @app.get("/models")
 async def get_models():
@@ -297,10 +695,14 @@ async def root():
         ]
     }
 
-# Baixar modelos ao iniciar
+# Carregar modelos e iniciar o worker ao iniciar
 @app.on_event("startup")
 async def startup_event():
-    download_models()
+    # Limitar o threadpool do anyio (código síncrono do FastAPI/Starlette), que por padrão tem 40 threads
+    anyio.to_thread.current_default_thread_limiter().total_tokens = CPU_WORKERS
+    load_models()
+    for _ in range(GPU_WORKERS):
+        WORKER_TASKS.append(asyncio.create_task(gpu_worker()))
 
 if __name__ == "__main__":
     import uvicorn